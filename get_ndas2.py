@@ -5,6 +5,79 @@ import ftplib
 import os
 import re
 import datetime
+import calendar
+import logging
+import logging.handlers
+import atexit
+import json
+import hashlib
+import socket
+import queue
+import contextlib
+import concurrent.futures
+
+# Number of simultaneous downloads, and of simultaneous directory
+# listings.  Each download and each listing uses its own ftp connection
+# from the pool, so the pool has NUM_WORKERS + NUM_LISTERS connections.
+# Keep that sum at or below the number of connections the ftp site
+# allows per host.  (The connection used to list the top directory is
+# closed before the pool is opened.)
+NUM_WORKERS=4
+NUM_LISTERS=2
+
+# Size of the receive buffer used for the ftp transfers.
+BLOCK_SIZE=1<<20
+
+# The log file, the messages are written to it from a background
+# thread, so the downloads never wait on the log.
+LOG_FILE='get_ndas2.log'
+
+log=logging.getLogger('get_ndas2')
+
+# Name of the manifest file, in OUTPUT_DIR, that records the size and
+# modification time of each source file when it was downloaded.
+MANIFEST_FILE='.cdas2_manifest.json'
+
+# The cdas2 directory names have the format cdas2.YYYYmmdd
+_CDAS2_RE=re.compile(r'cdas2\.(\d{4})(\d{2})(\d{2})$')
+
+# The cdas2 file names have the format cdas2.tHHz.sanl, where HH is
+# the two digit hour.
+_SANL_RE=re.compile(r'cdas2\.t(\d{2})z\.sanl$')
+
+# Extension of the optional checksum files on the ftp site.  If
+# source.sha256 exists, the downloaded source is checked against it.
+SHA256_EXT='.sha256'
+
+# A SHA-256 hex digest, as found in the checksum files
+_SHA256_RE=re.compile(r'[0-9a-f]{64}')
+
+# Lowercase month abbreviations, used for the output directory names.
+# Used instead of strftime('%b') to avoid the locale lookup per call.
+_MMM=('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+      'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+
+def setupLogging(logFile=LOG_FILE):
+    """Send the log messages to logFile
+
+    The messages are put on a queue by the calling threads, and written
+    to logFile by a QueueListener thread.  The listener is stopped, and
+    the queue flushed, when the program exits.
+    """
+
+    handler=logging.FileHandler(logFile)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logQueue=queue.Queue(-1)
+    listener=logging.handlers.QueueListener(logQueue, handler)
+    log.addHandler(logging.handlers.QueueHandler(logQueue))
+    log.setLevel(logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+
+def exitError(msg=''):
+    """Log msg as an error, and exit with msg on stderr"""
+    log.error(msg)
+    sys.exit("ERROR: {0}".format(msg))
 
 def getDirDate(inDir=''):
     """Strip the date from the cdas2 directory name.
@@ -22,20 +95,232 @@ def getDirDate(inDir=''):
     oDate = None
 
     # Verify the directory name has the correct format:
-    if re.fullmatch(r'cdas2\.\d{8}', inDir):
-        oDate = datetime.datetime.strptime(inDir, 'cdas2.%Y%m%d')
+    m = _CDAS2_RE.match(inDir)
+    if m:
+        try:
+            oDate = datetime.datetime(int(m[1]), int(m[2]), int(m[3]))
+        except ValueError:
+            # Not a valid date
+            pass
     return oDate
 
-def getFile(ftp='', source='', target=''):
+def getMlsdTime(fact=''):
+    """Convert an MLSD modify fact to a POSIX timestamp
+
+    The modify fact has the format YYYYmmddHHMMSS in UTC, optionally
+    followed by fractional seconds (RFC 3659).  The fractional seconds
+    are ignored.  The timestamp can be compared directly with the
+    st_mtime of a local file.  Return None if the fact is missing or
+    malformed.
+    """
+
+    if not fact or len(fact) < 14 or not fact[:14].isdigit():
+        return None
+    return calendar.timegm((int(fact[0:4]), int(fact[4:6]), int(fact[6:8]),
+                            int(fact[8:10]), int(fact[10:12]), int(fact[12:14])))
+
+def loadManifest(path=''):
+    """Read the download manifest from path
+
+    The manifest is a dictionary mapping each source file to the
+    [size, mtime] of the source when it was last downloaded, where
+    mtime is a POSIX timestamp.  If the download was verified, the
+    SHA-256 of the file is appended to the entry.  An empty manifest
+    is returned if the file does not exist, or cannot be read.
+    """
+
+    manifest={}
+    try:
+        with open(path) as fh:
+            manifest=json.load(fh)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as err:
+        log.warning("Unable to read the manifest \"{0}\", ignoring. ({1})".format(path, err))
+    if not isinstance(manifest, dict):
+        log.warning("Manifest \"{0}\" has the wrong format, ignoring.".format(path))
+        manifest={}
+
+    # Drop any entries that do not have the [size, mtime] or
+    # [size, mtime, sha256] format.
+    for source, entry in list(manifest.items()):
+        if not (isinstance(entry, list) and len(entry) in (2, 3) and
+                isinstance(entry[0], int) and isinstance(entry[1], (int, float)) and
+                all(isinstance(sha, str) for sha in entry[2:])):
+            log.warning("Manifest entry for \"{0}\" has the wrong format, ignoring.".format(source))
+            del manifest[source]
+    return manifest
+
+def saveManifest(path='', manifest=None):
+    """Write the download manifest to path
+
+    The manifest is written to a temporary file first, and then moved
+    into place, so an interrupted write does not corrupt the manifest.
+    """
+
+    tmpPath=path + '.tmp'
+    try:
+        with open(tmpPath, 'w') as fh:
+            json.dump(manifest, fh, indent=1, sort_keys=True)
+        os.replace(tmpPath, path)
+    except OSError as err:
+        log.warning("Unable to write the manifest \"{0}\". ([{1}] {2})".format(path, err.errno, err.strerror))
+
+def retrieveFile(pool=None, source='', target='', rest=0):
+    """Retrieve source on a leased pool connection into target
+
+    If rest is non-zero, the transfer is restarted at byte rest of the
+    source (REST), and appended to target.  Otherwise target is
+    overwritten.  The target is opened before the connection is
+    leased, and closed after it is returned, so a local file error
+    does not count against the connection.  Any ftplib or write errors
+    are passed on to the caller.
+    """
+
+    # Receive the data straight into one reusable buffer, and write it
+    # to the target unbuffered.  This avoids a callback, and a new bytes
+    # object, for every block that retrbinary would use.
+    buf=bytearray(BLOCK_SIZE)
+    mv=memoryview(buf)
+
+    with open(target, 'ab' if rest else 'wb', buffering=0) as fh:
+        fd=fh.fileno()
+        with pool.acquire() as ftp:
+            ftp.voidcmd('TYPE I')
+            with ftp.transfercmd('RETR {}'.format(source), rest or None) as sock:
+                while True:
+                    n=sock.recv_into(mv)
+                    if not n:
+                        break
+                    # os.write may not write the whole block
+                    written=0
+                    while written < n:
+                        written+=os.write(fd, mv[written:n])
+            ftp.voidresp()
+
+def dropCache(target=''):
+    """Drop the retrieved target from the page cache
+
+    The target files are large, and not used again by this script once
+    verified, so keep them from evicting the page cache.  DONTNEED only
+    drops clean pages, so the data is synced first.  This is done after
+    the ftp connection is released, and a failure is only logged, as
+    the download itself is complete.
+    """
+
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd=os.open(target, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as err:
+        log.warning("Unable to drop target file \"{0}\" from the page cache. ([{1}] {2})".format(target, err.errno, err.strerror))
+
+def getRemoteSha256(ftp=None, shaSource=''):
+    """Return the SHA-256 hex digest listed in the ftp file shaSource
+
+    The digest is the first field on the first line that is 64 hex
+    digits, which covers both the sha256sum and the BSD
+    "SHA256 (file) = digest" formats.  Return None if the file has no
+    digest.  Any ftplib errors are passed on to the caller.
+    """
+
+    lines=[]
+    ftp.retrlines('RETR {}'.format(shaSource), lines.append)
+    fields=lines[0].split() if lines else []
+    for field in fields:
+        if _SHA256_RE.fullmatch(field.lower()):
+            return field.lower()
+    return None
+
+def getSha256(path=''):
+    """Return the SHA-256 hex digest of the file path
+
+    hashlib.file_digest (Python 3.11+) is used when available, which
+    reads the file without extra copies and uses OpenSSL's hardware
+    accelerated SHA.  Any OSErrors are passed on to the caller.
+    """
+
+    with open(path, 'rb') as fh:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(fh, 'sha256').hexdigest()
+        sha=hashlib.sha256()
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            sha.update(block)
+        return sha.hexdigest()
+
+def verifyFile(pool=None, sha_source='', target=''):
+    """Check target against the checksum file sha_source on the ftp site
+
+    The checksum file is retrieved on a leased pool connection, the
+    target is hashed after the connection is returned.  If the
+    checksums differ, target is removed, so it is retrieved again.
+
+    Returns a (ok, target_sha) tuple.  ok is False only if the
+    checksums differ.  target_sha is the SHA-256 of the target if it
+    was verified, and None otherwise.
+    """
+
+    try:
+        with pool.acquire() as ftp:
+            source_sha=getRemoteSha256(ftp, sha_source)
+    except ftplib.all_errors as err:
+        log.warning("Unable to retrieve the checksum file \"{0}\", not verifying \"{1}\". ({2})".format(sha_source, target, err))
+        return True, None
+    if source_sha is None:
+        log.warning("Checksum file \"{0}\" has no SHA-256 digest, not verifying \"{1}\".".format(sha_source, target))
+        return True, None
+
+    try:
+        target_sha=getSha256(target)
+    except OSError as err:
+        log.warning("Unable to read target file \"{0}\" to verify it. ([{1}] {2})".format(target, err.errno, err.strerror))
+        return True, None
+
+    if source_sha != target_sha:
+        log.warning("Checksum of target \"{0}\" does not match \"{1}\", removing.".format(target, sha_source))
+        try:
+            os.remove(target)
+        except OSError as err:
+            log.warning("Unable to remove target file \"{0}\". ([{1}] {2})".format(target, err.errno, err.strerror))
+        return False, None
+    return True, target_sha
+
+def getFile(pool=None, source='', target='', source_size=None, source_mtime=None, manifest=None, sha_source=None):
     """Download the ftp file listed in source, and place in target
 
-    ftp must be a ftplib.FTP instace, and logged in.
+    pool must be an FTPPool instance.  A connection is leased from the
+    pool for the transfer, so getFile can be called from several
+    threads at once.
+
+    source_size and source_mtime are the size (int) and modification
+    time (POSIX timestamp) of the source file, as given in the MLSD
+    listing of the source directory.
+
+    manifest is the download manifest (see loadManifest).  If the
+    manifest entry for source matches source_size and source_mtime,
+    and the target exists with that size, the file is taken as already
+    retrieved without comparing times.  The manifest entry is updated
+    after a successful download, and dropped if the target is gone.
+
+    sha_source is the SHA256_EXT checksum file of source on the ftp
+    site, or None.  If given, the target is checked against it after
+    the download, or before an existing target is accepted.  A target
+    that does not match is removed, and the download fails.  The
+    checksum is stored in the manifest entry, so a later run does not
+    hash the target again.
 
     This function will check if the file exists.  If it does exist,
     then it will check the size and date stamp.  If the file on the
     ftp site is newer, or a different size, then the file will be
     downloaded again.  If the size is the same, and the date stamp on
-    the ftp site is older, then the download will not be retried.
+    the ftp site is older, then the download will not be retried.  If
+    the target is smaller than the source, and newer, only the missing
+    part of the file is downloaded.
 
     This funtion will return True if successful (or if the file didn't
     need to be downloaded).
@@ -44,59 +329,253 @@ def getFile(ftp='', source='', target=''):
     # Default return value
     myRet=False
 
-    # Check if ftp is an ftplib.FTP instance
-    if isinstance(ftp, ftplib.FTP):
-        # Check if the target file exists
+    # The manifest entry for the source, or None if the size or
+    # modification time of the source is not known.
+    remote_meta=None
+    if source_size is not None and source_mtime is not None:
+        remote_meta=[source_size, source_mtime]
 
+    # Check if pool is an FTPPool instance
+    if isinstance(pool, FTPPool):
         # To indicate if the download should be attempted.
         doDownload=True
 
-        # Check if the target file exists
-        if os.path.isfile(target):
-            # Need to get file sizes and ctime
-            try:
-                target_size=os.path.getsize(target)
-                target_ctime=datetime.datetime.fromtimestamp(os.path.getctime(target))
-            except OSError as err:
-                print("WARNING: Unable to get the size or ctime of the target file \"{0}\".".format(target), file=sys.stderr)
-                print("WARNING: Retrying the download. ([{0}] {1})".format(err.errno, err.strerror), file=sys.stderr)
-            else:
-                # Need to get source size and ctime
-                try:
-                    source_size=ftp.size(source)
-                    source_ctime_str=ftp.sendcmd('MDTM {}'.format(source))
-                    source_ctime=datetime.datetime.strptime(source_ctime_str, '213 %Y%m%d%H%M%S')
-                except ftplib.all_errors as err:
-                    print("WARNING: Unable to get the size or ctime of the source file \"{0}\".".format(source), file=sys.stderr)
-                    print("WARNING: Retrying the download. ({1})".format(err), file=sys.stderr)
-
-                # Check if the files are the _same_. Same here is that
-                # the file sizes are the same, and the source ctime is
-                # older than the target's ctime.
-                if source_size == target_size and source_ctime < target_ctime:
-                    print("NOTE: File \"{0}\" already retrieved.".format(source), file=sys.stderr)
-                    doDownload = False
-                else:
-                    print("WARNING: Target \"{0}\" exists, but does not match the source \"{1}\".".format(target, source), file=sys.stderr)
-                    print("WARNING: Retrieving.", file=sys.stderr)
-        # Now do the download
+        # The size of a partial target to resume from, 0 to download
+        # the whole file.
+        resume_size=0
+
+        # The verified SHA-256 of the target, for the manifest
+        target_sha=None
+
+        # Check if the target file exists, and get its size and mtime
+        # with a single stat.
         try:
-            ftp.retrbinary('RETR {}'.format(source), open(target, 'wb').write)
-        except ftplib.all_errors as err:
-            print("WARNING: Error while attemptint to retrieve file \"{0}\". ({1})".format(source, err), file=sys.stderr)
+            st=os.stat(target)
+        except FileNotFoundError:
+            # The target was removed, so its manifest entry, if any, no
+            # longer applies.
+            if manifest is not None:
+                manifest.pop(source, None)
         except OSError as err:
-            print("WARNING: Unable to write target file \"{0}\". ([{1}] {2})".format(target, err.errno, err.strerror), file=sys.stderr)
+            log.warning("Unable to get the size or mtime of the target file \"{0}\".".format(target))
+            log.warning("Retrying the download. ([{0}] {1})".format(err.errno, err.strerror))
         else:
+            target_size=st.st_size
+            # Use the mtime, as the source time from MLSD is also a
+            # modification time.
+            target_mtime=st.st_mtime
+
+            # Check the manifest first.  An entry matching the listing
+            # means the target was retrieved from this version of the
+            # source, so the mtime comparison below is not needed.  If
+            # the source has a checksum file, the entry must also have
+            # the verified checksum of the target, else the target is
+            # verified below.
+            entry=manifest.get(source, []) if manifest is not None else []
+            if (remote_meta is not None and entry[:2] == remote_meta and
+                target_size == source_size and (not sha_source or len(entry) == 3)):
+                return True
+
+            # Check if the files are the _same_. Same here is that
+            # the file sizes are the same, and the source mtime is
+            # older than the target's mtime.
+            if (source_size is not None and source_mtime is not None and
+                source_size == target_size and source_mtime < target_mtime):
+                if sha_source:
+                    ok, target_sha=verifyFile(pool, sha_source, target)
+                else:
+                    ok=True
+                if ok:
+                    log.info("File \"{0}\" already retrieved.".format(source))
+                    doDownload = False
+            elif (source_size is not None and source_mtime is not None and
+                  0 < target_size < source_size and source_mtime < target_mtime):
+                # The target is likely a partial download of the
+                # current source, from an earlier run.
+                log.warning("Target \"{0}\" is smaller than the source \"{1}\".".format(target, source))
+                log.warning("Resuming at byte {0}.".format(target_size))
+                resume_size=target_size
+            else:
+                log.warning("Target \"{0}\" exists, but does not match the source \"{1}\".".format(target, source))
+                log.warning("Retrieving.")
+        if not doDownload:
             myRet = True
+            # Record the up to date target, so the next run can skip
+            # the stat.
+            if manifest is not None and remote_meta is not None:
+                manifest[source]=remote_meta + ([target_sha] if target_sha else [])
+        else:
+            # Now do the download.  retrieveFile leases a connection
+            # from the pool for each transfer, inside the try, so a
+            # broken transfer closes its connection rather than
+            # returning it to the pool out of sync.
+            try:
+                done=False
+                if resume_size:
+                    # Only transfer the missing tail of the target
+                    try:
+                        retrieveFile(pool, source, target, resume_size)
+                        done=os.path.getsize(target) == source_size
+                    except ftplib.all_errors as err:
+                        log.warning("Unable to resume the download of \"{0}\". ({1})".format(source, err))
+                    if not done:
+                        log.warning("Resumed download of \"{0}\" is incomplete, retrieving the whole file.".format(source))
+                if not done:
+                    retrieveFile(pool, source, target)
+            except ftplib.all_errors as err:
+                log.warning("Error while attemptint to retrieve file \"{0}\". ({1})".format(source, err))
+            else:
+                myRet = True
+
+            # Verify the download against the checksum on the ftp site
+            if myRet and sha_source:
+                myRet, target_sha=verifyFile(pool, sha_source, target)
+
+            if myRet:
+                dropCache(target)
+
+            if myRet and manifest is not None and remote_meta is not None:
+                manifest[source]=remote_meta + ([target_sha] if target_sha else [])
     return myRet
-            
+
+class TunedFTP(ftplib.FTP):
+    """An ftplib.FTP with socket options set for bulk transfers
+
+    The control connection has TCP keepalive on, so it survives long
+    transfers on the data connections, and Nagle disabled, as it only
+    carries short commands.  The data connections have TCP keepalive
+    on.  Their buffer sizes are left to the kernel: setting SO_RCVBUF
+    after connect is too late for window scaling, and on Linux it turns
+    off receive buffer autotuning.
+    """
+
+    def connect(self, *args, **kwargs):
+        resp=super().connect(*args, **kwargs)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return resp
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size=super().ntransfercmd(cmd, rest)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return conn, size
+
+def ftpConnect(ftpUrl='', ftpPath=''):
+    """Connect to the ftp site, login, and change to ftpPath
+
+    Returns a logged in TunedFTP instance.  Any ftplib errors are
+    passed on to the caller.
+    """
+
+    ftp=TunedFTP(ftpUrl)
+    try:
+        ftp.login()
+        ftp.cwd(ftpPath)
+    except ftplib.all_errors:
+        ftp.close()
+        raise
+    return ftp
+
+def listDir(pool=None, inDir=''):
+    """List the cdas2 analysis files in the ftp directory inDir
+
+    pool must be an FTPPool instance.  The directory is listed with
+    MLSD on a leased connection, without changing directory, so
+    several directories can be listed at once.  Only the files with
+    names of the format cdas2.tHHz.sanl are returned.
+
+    Returns a list of (name, hour, facts, shaName) tuples for the
+    files in inDir, where hour is the two digit hour from the name,
+    facts has the size and modify facts of the file, and shaName is
+    the name of the file's SHA256_EXT checksum file, or None if there
+    is not one.  Any ftplib errors are passed on to the caller.
+    """
+
+    with pool.acquire() as ftp:
+        entries=list(ftp.mlsd(inDir, facts=["size", "modify", "type"]))
+
+    names={name for name, facts in entries if facts.get("type") == "file"}
+
+    files=[]
+    for name, facts in entries:
+        if name not in names:
+            continue
+        m=_SANL_RE.match(name)
+        if m:
+            shaName=name + SHA256_EXT
+            files.append((name, m[1], facts, shaName if shaName in names else None))
+    return files
+
+class FTPPool:
+    """A pool of logged in ftp connections
+
+    Each connection is connected to ftpUrl, logged in, and in the
+    ftpPath directory.  A connection is leased with acquire(), and is
+    returned to the pool when the with block exits.  A single ftp
+    control connection can only run one transfer at a time, so the
+    pool size limits the number of simultaneous transfers.
+    """
+
+    def __init__(self, ftpUrl='', ftpPath='', size=NUM_WORKERS):
+        self.size=size
+        self._ftpUrl=ftpUrl
+        self._ftpPath=ftpPath
+        self._connections=queue.Queue()
+        try:
+            for _ in range(size):
+                self._connections.put(ftpConnect(ftpUrl, ftpPath))
+        except ftplib.all_errors:
+            # Clean up the connections already made
+            self.close()
+            raise
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Lease a connection, waiting for one to become free
+
+        An error reply from the server (error_reply, error_perm or
+        error_temp) has been read in full, so the connection is still
+        in sync, and is returned to the pool.  Any other error that
+        leaves the with block, from a socket, an EOF, or the middle of
+        a transfer, may leave the connection dead, or out of sync with
+        the server's replies.  That connection is closed, and a new
+        connection is made on the next lease of its slot.
+        """
+        ftp=self._connections.get()
+        try:
+            if ftp is None:
+                ftp=ftpConnect(self._ftpUrl, self._ftpPath)
+            yield ftp
+        except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
+            raise
+        except BaseException:
+            if ftp is not None:
+                ftp.close()
+            ftp=None
+            raise
+        finally:
+            self._connections.put(ftp)
+
+    def close(self):
+        """Close all the connections in the pool"""
+        while True:
+            try:
+                ftp=self._connections.get_nowait()
+            except queue.Empty:
+                break
+            if ftp is None:
+                continue
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
 def main():
     """Download cdas2 files from ftp.ncep.noaa.gov
 
     This application will download the files from ncep for use in the
     GFDL seasonal prediction.
 
-    TODO: Add real logging (to a file)
     TODO: Add a configuration file
     """
     
@@ -105,16 +584,18 @@ def main():
     
     OUTPUT_DIR="/home/sdu/Development/nmme/pythonFtpTests/ncep_reanal/testData"
 
+    setupLogging()
+
     # Make sure OUTPUT_DIR exists.
     # Exit if it doesn't.
     if not os.path.isdir(OUTPUT_DIR):
-        exit("ERROR: Directory \"{0}\" does not exist.  Please create, and try again.".format(OUTPUT_DIR))
+        exitError("Directory \"{0}\" does not exist.  Please create, and try again.".format(OUTPUT_DIR))
 
     # Connect to host, default port
     try:
-        ftp=ftplib.FTP(ftpUrl)
+        ftp=TunedFTP(ftpUrl)
     except ftplib.all_errors as err:
-        exit("ERROR: Unable to connect to ftp site \"{0}\": ({1}).".format(ftpUrl, re.sub(r'\[.+\]', '', str(err)).strip()))
+        exitError("Unable to connect to ftp site \"{0}\": ({1}).".format(ftpUrl, re.sub(r'\[.+\]', '', str(err)).strip()))
 
     
     # Anonymous login
@@ -123,7 +604,7 @@ def main():
     except ftplib.all_errors as err:
         # Clean up ftp connection, and exit
         ftp.quit()
-        exit("ERROR: Unable to login to ftp site \"{0}\": ({1}).".format(ftpUrl, err))
+        exitError("Unable to login to ftp site \"{0}\": ({1}).".format(ftpUrl, err))
 
     # change to the correct directory
     try:
@@ -131,70 +612,140 @@ def main():
     except ftplib.all_errors as err:
         # Clean up ftp connection, and exit
         ftp.quit()
-        exit("ERROR: Unable to change to directory \"{0}\": ({1}).".format(ftpUrl, err))
+        exitError("Unable to change to directory \"{0}\": ({1}).".format(ftpUrl, err))
 
     # Get the names of all directories in the cwd
     try:
-        dirs=ftp.nlst()
+        dirs=[name for name, facts in ftp.mlsd(facts=["type"]) if facts.get("type") == "dir"]
     except ftplib.all_errors as err:
-        exit("ERROR: Unable to list directories: ({0}).".format(err))
-
-    for inDir in dirs:
-        # Get the date from the filename, which is the extension of the
-        # directory, and remove the '.' from the extension.
-        dirDate=getDirDate(inDir)
-        if not dirDate:
-            print("WARNING: Not able to extract the date from the directory name.  Skipping {1} . . .".format(inDir),
-                  file=sys.stderr)
-            continue
-        
-        # Set the output directory to be YYYYmmm where mmm is the
-        # lowercase month abbreviation.
-        outDir=dirDate.strftime('%Y%b').lower()
-
-        fullOutDir=os.path.join(OUTPUT_DIR, outDir)
-        # Need to make sure the output directory exists
-        if not os.path.isdir(fullOutDir):
-            try:
-                os.mkdir(fullOutDir)
-            except OSError as err:
-                print("WARNING: Unable to create directory \"{0}\".  Skipping all files in \"{1}\". ([{3}] {4})".format(fullOutDir,
-                                                                                                                        inDir,
-                                                                                                                        err.errno,
-                                                                                                                        err.strerror),
-                      file=sys.stderr)
-                continue
-                         
-        print("NOTE: Files from directory \"{0}\" will be placed in \"{1}\".".format(inDir, outDir), file=sys.stderr)
-        # Enter the directory
-        try:
-            ftp.cwd(inDir)
-        except ftplib.all_errors as err:
-            print("WARNING: Unable to enter ftp directory \"{0}\".  Skipping . . .".format(inDir),
-                  file=sys.stderr)
+        exitError("Unable to list directories: ({0}).".format(err))
+    ftp.quit()
+
+    # The pool connections are used both to list the directories, and
+    # to download the files.
+    try:
+        pool=FTPPool(ftpUrl, ftpPath, NUM_WORKERS + NUM_LISTERS)
+    except ftplib.all_errors as err:
+        exitError("Unable to open {0} connections to ftp site \"{1}\": ({2}).".format(NUM_WORKERS + NUM_LISTERS, ftpUrl, err))
+
+    # Read the manifest of the files already downloaded
+    manifestPath=os.path.join(OUTPUT_DIR, MANIFEST_FILE)
+    manifest=loadManifest(manifestPath)
+    origManifest=dict(manifest)
 
-        # Get a list of file in the new directory
+    # The directory listings and the downloads run in separate
+    # executors.  The downloads for a directory are submitted as soon
+    # as its listing is done, so the downloads do not wait for all the
+    # directories to be listed.
+    lister=concurrent.futures.ThreadPoolExecutor(max_workers=NUM_LISTERS)
+    downloader=concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    try:
         try:
-            files=ftp.nlst()
-        except ftplib.all_errors as err:
-            print("WARNING: Unable to get a list of file in directory \"{0}\".  Skipping . . .".format(inDir), file=sys.stderr)
-            ftp.cwd("..")
-            continue
-        
-        for inFile in files:
-            # The inFile names have the format: cdas2.t??z.sanl
-            # where ?? is the two digit hour.
-        
-            # Set the output file name, need the date from the directory,
-            # will have the format: sig.anl.YYYYMMDDHH.
-            outFile="sig.anl.{0}{1}.ieee".format(dirDate.strftime('%Y%m%d'), inFile[7:9])
-
-            # Download the file
-            getFile(ftp, inFile, os.path.join(fullOutDir, outFile))
-        # Return to the parent directory
-        ftp.cwd("..")
-    ftp.quit()
+            # Map of the listDir futures to (inDir, ymd, fullOutDir)
+            listings={}
+
+            # Map of the getFile futures to their source
+            downloads={}
+
+            # The output directories already created
+            madeDirs=set()
+
+            for inDir in dirs:
+                # Get the date from the filename, which is the extension of the
+                # directory, and remove the '.' from the extension.
+                dirDate=getDirDate(inDir)
+                if not dirDate:
+                    log.warning("Not able to extract the date from the directory name.  Skipping {0} . . .".format(inDir))
+                    continue
+
+                # Set the output directory to be YYYYmmm where mmm is the
+                # lowercase month abbreviation.
+                outDir="{0}{1}".format(dirDate.year, _MMM[dirDate.month-1])
+
+                fullOutDir=os.path.join(OUTPUT_DIR, outDir)
+                # Need to make sure the output directory exists.  Several
+                # ftp directories share an output directory, so only
+                # create each one once.
+                if fullOutDir not in madeDirs:
+                    try:
+                        os.makedirs(fullOutDir, exist_ok=True)
+                    except OSError as err:
+                        log.warning("Unable to create directory \"{0}\".  Skipping all files in \"{1}\". ([{2}] {3})".format(fullOutDir, inDir, err.errno, err.strerror))
+                        continue
+                    madeDirs.add(fullOutDir)
+
+                log.info("Files from directory \"{0}\" will be placed in \"{1}\".".format(inDir, outDir))
+                # The YYYYmmdd date used in the output file names
+                ymd="{0:04d}{1:02d}{2:02d}".format(dirDate.year, dirDate.month, dirDate.day)
+                # List the directory on one of the pool connections
+                listings[lister.submit(listDir, pool, inDir)]=(inDir, ymd, fullOutDir)
+
+            for future in concurrent.futures.as_completed(listings):
+                inDir, ymd, fullOutDir=listings[future]
+                try:
+                    files=future.result()
+                except ftplib.all_errors as err:
+                    log.warning("Unable to get a list of file in directory \"{0}\".  Skipping . . . ({1})".format(inDir, err))
+                    continue
+
+                for inFile, hour, facts, shaFile in files:
+                    # The inFile names have the format: cdas2.t??z.sanl
+                    # where ?? is the two digit hour.
+
+                    # Set the output file name, need the date from the directory,
+                    # will have the format: sig.anl.YYYYMMDDHH.
+                    outFile="sig.anl.{0}{1}.ieee".format(ymd, hour)
+
+                    # Download the file.  The source is relative to
+                    # ftpPath, as the pool connections do not change
+                    # directory.
+                    try:
+                        source_size=int(facts["size"])
+                    except (KeyError, ValueError):
+                        source_size=None
+                    source="{0}/{1}".format(inDir, inFile)
+                    future=downloader.submit(getFile, pool, source, os.path.join(fullOutDir, outFile),
+                                             source_size, getMlsdTime(facts.get("modify")), manifest,
+                                             "{0}/{1}".format(inDir, shaFile) if shaFile else None)
+                    downloads[future]=source
+
+            # Wait for the listings and downloads to finish.  The
+            # executors are not used as context managers, as their exit
+            # would wait for all the queued work even on Ctrl-C.
+            lister.shutdown(wait=True)
+            downloader.shutdown(wait=True)
+        except BaseException:
+            # On Ctrl-C, or any other error, drop the queued listings
+            # and downloads, and wait for the running ones to finish.
+            # The pool and the manifest must not be touched while the
+            # workers are still running.
+            lister.shutdown(wait=False, cancel_futures=True)
+            downloader.shutdown(wait=False, cancel_futures=True)
+            lister.shutdown(wait=True)
+            downloader.shutdown(wait=True)
+            raise
+
+        # The executors are done, check the result of each download.
+        # getFile logs its own failures, but any other exception would
+        # otherwise be lost with the future.
+        failed=0
+        for future, source in downloads.items():
+            try:
+                ok=future.result()
+            except Exception as err:
+                log.error("Unexpected error while retrieving file \"{0}\". ({1!r})".format(source, err))
+                ok=False
+            if not ok:
+                failed+=1
+        log.info("Retrieved {0} of {1} files.".format(len(downloads) - failed, len(downloads)))
+    finally:
+        pool.close()
+        # Only write the manifest if there are new downloads
+        if manifest != origManifest:
+            saveManifest(manifestPath, manifest)
 
+    if failed:
+        exitError("Unable to retrieve {0} of {1} files.".format(failed, len(downloads)))
 
 
 if __name__ == '__main__':